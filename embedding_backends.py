@@ -0,0 +1,182 @@
+# Importing necessary libraries
+import os  # To inspect local model directories
+import json  # To read the sentence-transformers model configuration
+import atexit  # To shut down the multi-GPU worker pool when the program exits
+import torch  # For tensor operations and GPU detection
+from typing import List, Optional  # For type hinting lists and optional arguments
+
+# Importing LangChain components for embeddings
+from langchain.embeddings import HuggingFaceBgeEmbeddings  # Default PyTorch embeddings backend
+from langchain.embeddings.base import Embeddings  # Base interface shared by all embeddings backends
+from langchain.embeddings.huggingface import DEFAULT_QUERY_BGE_INSTRUCTION_EN  # Query prefix used by BGE models
+
+# Suffixes added by `optimum-cli` to optimized/quantized ONNX files, in order of preference
+ONNX_FILE_PREFERENCE = ["_quantized.onnx", "_optimized.onnx", ".onnx"]
+
+
+# Function to read a JSON file of a sentence-transformers model
+def read_model_config(model_name: str, file_name: str) -> Optional[dict]:
+    """
+    Returns the parsed file from a local model directory or the HuggingFace Hub, or None if it cannot be found.
+    """
+    try:
+        if os.path.isdir(model_name):
+            config_path = os.path.join(model_name, file_name)
+        else:
+            from huggingface_hub import hf_hub_download
+            config_path = hf_hub_download(model_name, file_name)
+        with open(config_path) as config_file:
+            return json.load(config_file)
+    except Exception:
+        return None
+
+
+# Function to find out how a sentence-transformers model pools its token embeddings
+def read_pooling_mode(model_name: str) -> str:
+    """
+    Returns 'cls' or 'mean' from the model's 1_Pooling/config.json.
+    Falls back to 'cls' for BGE models and 'mean' otherwise when the config cannot be found.
+    """
+    config = read_model_config(model_name, "1_Pooling/config.json")
+    if config is None:
+        return "cls" if "bge" in os.path.basename(model_name.rstrip("/\\")).lower() else "mean"
+    return "cls" if config.get("pooling_mode_cls_token") else "mean"
+
+
+# Function to find the sequence length a sentence-transformers model truncates its input to
+def read_max_seq_length(model_name: str) -> Optional[int]:
+    """
+    Returns max_seq_length from the model's sentence_bert_config.json, or None if it cannot be found.
+    """
+    config = read_model_config(model_name, "sentence_bert_config.json")
+    return config.get("max_seq_length") if config else None
+
+
+# Embeddings backend running the model through ONNX Runtime instead of PyTorch
+class OnnxBgeEmbeddings(Embeddings):
+    """
+    Embeds text with an ONNX export of a HuggingFace model, followed by L2 normalization.
+    Uses the same pooling ([CLS] token for BGE models, mean pooling otherwise) and truncation length as the
+    model's sentence-transformers configuration, so vectors match the PyTorch backend.
+    """
+
+    def __init__(self, model_name: str, device: str = "cpu", batch_size: int = 64,
+                 query_instruction: str = DEFAULT_QUERY_BGE_INSTRUCTION_EN, pooling: Optional[str] = None):
+        # Imported here so optimum is only required when the ONNX backend is selected
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        if device.startswith("cuda"):
+            # Keep the GPU index of devices such as "cuda:1"
+            provider = "CUDAExecutionProvider"
+            provider_options = {"device_id": int(device.split(":", 1)[1]) if ":" in device else 0}
+        else:
+            provider, provider_options = "CPUExecutionProvider", None
+        # Reuse an optimized/quantized model from a local directory, otherwise export the model on the fly
+        file_name = None
+        if os.path.isdir(model_name):
+            onnx_files = [name for name in os.listdir(model_name) if name.endswith(".onnx")]
+            file_name = next((name for suffix in ONNX_FILE_PREFERENCE
+                              for name in sorted(onnx_files) if name.endswith(suffix)), None)
+        if file_name is None:
+            self.model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True, provider=provider,
+                                                                      provider_options=provider_options)
+        else:
+            self.model = ORTModelForFeatureExtraction.from_pretrained(model_name, file_name=file_name,
+                                                                      provider=provider,
+                                                                      provider_options=provider_options)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.batch_size = batch_size
+        self.query_instruction = query_instruction
+        self.pooling = pooling or read_pooling_mode(model_name)
+        # Truncate like sentence-transformers does; fall back to the tokenizer's own limit
+        self.max_length = read_max_seq_length(model_name) or self.tokenizer.model_max_length
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds texts in batches and returns one normalized vector per text, in the order of the input.
+        Texts are batched by length so each padded batch holds similarly sized texts.
+        """
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(texts), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            batch = [texts[i] for i in indices]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=self.max_length,
+                                    return_tensors="pt")
+            outputs = self.model(**inputs)
+            if self.pooling == "cls":
+                # Use the [CLS] token embedding, as BGE models are trained to
+                pooled = outputs.last_hidden_state[:, 0]
+            else:
+                # Mean-pool the token embeddings, ignoring padding tokens
+                mask = inputs["attention_mask"].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+                pooled = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            for i, vector in zip(indices, torch.nn.functional.normalize(pooled, p=2, dim=1).tolist()):
+                vectors[i] = vector
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed([text.replace("\n", " ") for text in texts])
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([self.query_instruction + text.replace("\n", " ")])[0]
+
+
+# Embeddings backend sharding document batches across every visible GPU
+class MultiGPUEmbeddings(Embeddings):
+    """
+    Embeds documents with a SentenceTransformer multi-process pool, one worker per GPU.
+    Queries are embedded by the model in the main process.
+    """
+
+    def __init__(self, model, batch_size: int = 64, query_instruction: str = DEFAULT_QUERY_BGE_INSTRUCTION_EN):
+        self.model = model
+        self.pool = model.start_multi_process_pool()  # Starts one worker process per CUDA device
+        atexit.register(model.stop_multi_process_pool, self.pool)
+        self.batch_size = batch_size
+        self.query_instruction = query_instruction
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        vectors = self.model.encode_multi_process([text.replace("\n", " ") for text in texts], self.pool,
+                                                  batch_size=self.batch_size)
+        # Normalize here, as older sentence-transformers versions do not normalize in encode_multi_process
+        return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.encode(self.query_instruction + text.replace("\n", " "),
+                                 normalize_embeddings=True).tolist()
+
+
+# Function to create the embeddings model for the configured backend
+def load_embeddings(backend: str, model_name: str, device: str, batch_size: int, fp16: bool = False,
+                    int8: bool = False, multi_gpu: bool = False) -> Embeddings:
+    """
+    Returns the embeddings model for the given backend ('huggingface' or 'onnx'), already warmed up.
+    With fp16, the PyTorch model runs in half precision when it is placed on a GPU.
+    With int8, the linear layers of the PyTorch model are dynamically quantized when it runs on the CPU.
+    With multi_gpu, document embedding is sharded across all GPUs when device is 'cuda' and more than one is visible.
+    """
+    if backend == "onnx":
+        embeddings = OnnxBgeEmbeddings(model_name=model_name, device=device, batch_size=batch_size)
+    elif backend == "huggingface":
+        embeddings = HuggingFaceBgeEmbeddings(model_name=model_name,
+                                              model_kwargs={"device": device},
+                                              encode_kwargs={"normalize_embeddings": True, "batch_size": batch_size})
+        if fp16 and device.startswith("cuda"):
+            embeddings.client.half()  # Halve memory traffic and use the GPU's FP16 tensor cores
+        if int8 and device == "cpu":
+            # Run the transformer's matrix multiplications with INT8 weights (uses VNNI instructions where available)
+            transformer = embeddings.client[0]
+            transformer.auto_model = torch.quantization.quantize_dynamic(transformer.auto_model, {torch.nn.Linear},
+                                                                         dtype=torch.qint8)
+        if multi_gpu and device == "cuda" and torch.cuda.device_count() > 1:
+            embeddings = MultiGPUEmbeddings(embeddings.client, batch_size=batch_size,
+                                            query_instruction=embeddings.query_instruction)
+    else:
+        raise ValueError(f"Embeddings backend '{backend}' is not supported. Please choose either 'huggingface' or 'onnx'")
+    # Run one query up front so model loading and kernel initialization do not delay the first real batch
+    embeddings.embed_query("warmup")
+    return embeddings
@@ -7,17 +7,23 @@
 # !pip install chromadb
 # !pip install sentence-transformers
 # !pip install transformers
+# !pip install pymupdf
 
 # Importing necessary libraries
 import os  # To interact with the operating system, such as reading environment variables
-import glob  # For file pattern matching (used to find documents)
+import hashlib  # To hash chunk contents into stable ids
 import chromadb  # For vector storage and embeddings
+import torch  # To detect whether a CUDA-capable GPU is available for embeddings
+import fitz  # PyMuPDF, for fast PDF text extraction
 
 # Importing additional components from specific packages
 from chromadb.config import Settings  # Settings configuration for ChromaDB
-from typing import List  # For type hinting lists
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple  # For type hinting collections and generators
 from dotenv import load_dotenv  # To load environment variables from a .env file
 from multiprocessing import Pool  # Enables parallel processing for efficiency
+from collections import deque  # Queue of loading tasks in flight
+from itertools import islice  # To submit only the first few loading tasks up front
+from functools import partial  # To pre-bind loader arguments
 from tqdm import tqdm  # For progress bar functionality
 
 # Importing document loaders for various file types
@@ -31,19 +37,16 @@ from langchain.document_loaders import (
     UnstructuredODTLoader,
     UnstructuredPowerPointLoader,
     UnstructuredWordDocumentLoader,
-    UnstructuredEPubLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredMarkdownLoader,
-    PyMuPDFLoader,
-    PyPDFLoader
+    UnstructuredEPubLoader
 )
+from langchain.document_loaders.base import BaseLoader  # Base class for custom document loaders
 
 # Importing additional LangChain components for document processing and embeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceBgeEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.docstore.document import Document
 from constants import CHROMA_SETTINGS  # Import Chroma settings defined in constants.py
+from embedding_backends import load_embeddings  # Builds the embeddings model for the configured backend
 
 # Load environment variables
 if not load_dotenv():
@@ -56,6 +59,57 @@ chunk_overlap = 100  # Overlap size for chunk splitting
 persist_directory = os.environ.get('PERSIST_DIRECTORY')  # Directory for storing Chroma vectors
 source_directory = os.environ.get('SOURCE_DIRECTORY', 'source_documents')  # Source directory for documents
 embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME')  # Embeddings model name
+embeddings_backend = os.environ.get('EMBEDDINGS_BACKEND', 'huggingface')  # 'huggingface' (PyTorch) or 'onnx'
+# Device for the embeddings model; defaults to the GPU when one is available
+embeddings_device = os.environ.get('EMBEDDINGS_DEVICE', 'cuda' if torch.cuda.is_available() else 'cpu')
+embeddings_batch_size = int(os.environ.get('EMBEDDINGS_BATCH_SIZE', 1024))  # Chunks encoded per forward pass
+embeddings_fp16 = os.environ.get('EMBEDDINGS_FP16', '0') == '1'  # Run the embeddings model in FP16 on the GPU
+embeddings_int8 = os.environ.get('EMBEDDINGS_INT8', '0') == '1'  # Quantize the embeddings model to INT8 on the CPU
+# Chunks embedded and written to Chroma per upsert call; never smaller than the embeddings batch,
+# otherwise each embed_documents() call would be capped below EMBEDDINGS_BATCH_SIZE
+upsert_batch_size = max(512, embeddings_batch_size)
+collection_name = 'langchain'  # Default collection name used by LangChain's Chroma wrapper
+# HNSW index settings applied when the collection is first created: cosine distance, a denser graph (M) and a
+# wider candidate list at build and query time for better recall on small top-k lookups
+collection_metadata = {'hnsw:space': 'cosine', 'hnsw:M': 32, 'hnsw:construction_ef': 200, 'hnsw:search_ef': 64}
+metadata_page_size = 10_000  # Metadata rows fetched per request when listing already ingested sources
+# Collection recording every processed file and its modification time, including files that produced no chunks
+sources_collection_name = 'ingested_sources'
+sources_write_batch_size = 5000  # Source records written per upsert call (below Chroma's maximum batch size)
+# Loading and embedding run at the same time. When embedding runs on the CPU, the cores are split between the
+# loader worker processes and the PyTorch threads instead of oversubscribing the CPU; on a GPU, embedding needs
+# little CPU, so the loaders get all but one core
+default_ingest_workers = os.cpu_count() // 2 if embeddings_device == 'cpu' else os.cpu_count() - 1
+ingest_workers = int(os.environ.get('INGEST_WORKERS', max(1, default_ingest_workers)))
+torch_num_threads = int(os.environ.get('TORCH_NUM_THREADS', max(1, os.cpu_count() - ingest_workers)))
+max_files_per_task = 16  # Upper bound on the files sent to a worker in one task
+tasks_in_flight = ingest_workers * 2  # Loading tasks submitted ahead of the embedding stage
+
+# Text splitter shared by the worker processes
+text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+# Custom PDF loader extracting page text with PyMuPDF in a single pass over the document
+class FastPyMuPDFLoader(BaseLoader):
+    """
+    Loads a PDF with PyMuPDF, returning one Document per page that contains text.
+    Pages are extracted sequentially because PyMuPDF is not thread-safe; parallelism comes
+    from loading several files at once in the worker pool.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def lazy_load(self) -> Iterator[Document]:
+        with fitz.open(self.file_path) as doc:
+            for page in doc:
+                text = page.get_text()
+                if text.strip():  # Skip blank or image-only pages
+                    yield Document(page_content=text,
+                                   metadata={"source": self.file_path, "file_path": self.file_path,
+                                             "page": page.number, "total_pages": doc.page_count})
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
 
 # Mapping of file extensions to their respective document loaders
 LOADER_MAPPING = {
@@ -69,96 +123,241 @@ LOADER_MAPPING = {
     ".odt": (UnstructuredODTLoader, {}),
     ".ppt": (UnstructuredPowerPointLoader, {}),
     ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".pdf": (PyMuPDFLoader, {}),
+    ".pdf": (FastPyMuPDFLoader, {}),
     ".txt": (TextLoader, {"encoding": "utf8"})
 }
 
+# Loader constructors with their arguments pre-bound, looked up once per file
+LOADER_FACTORY = {ext: partial(loader_class, **loader_args) for ext, (loader_class, loader_args) in LOADER_MAPPING.items()}
+
 # Function to load a single document based on its file extension
 def load_single_document(file_path: str) -> List[Document]:
     """
     Loads a single document based on the file extension and returns a list of Document objects.
     """
-    ext = "." + file_path.rsplit(".", 1)[-1].lower()  # Extract the file extension
-    if ext in LOADER_MAPPING:
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        loader = loader_class(file_path, **loader_args)
-        return loader.load()
-    raise ValueError(f"Unsupported file extension '{ext}'")  # Error if extension is unsupported
-
-# Function to load multiple documents from the specified directory
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
-    """
-    Loads all documents from the specified directory, ignoring files in ignored_files list.
-    """
-    all_files = []  # List to store file paths
-    for ext in LOADER_MAPPING:
-        # Find all files with each extension (case insensitive) and add to the list
-        all_files.extend(glob.glob(os.path.join(source_dir, f"**/*{ext.lower()}"), recursive=True))
-        all_files.extend(glob.glob(os.path.join(source_dir, f"**/*{ext.upper()}"), recursive=True))
-    # Filter out ignored files
-    filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
-    
-    # Load documents in parallel to speed up processing
-    with Pool(processes=os.cpu_count()) as pool:
-        results = []
-        with tqdm(total=len(filtered_files), desc='Loading new documents', ncols=80) as pbar:
-            for i, docs in enumerate(pool.imap_unordered(load_single_document, filtered_files)):
-                results.extend(docs)
-                pbar.update()  # Update progress bar
-    return results
+    ext = os.path.splitext(file_path)[1].lower()  # Extract the file extension
+    factory = LOADER_FACTORY.get(ext)
+    if factory is None:
+        raise ValueError(f"Unsupported file extension '{ext}'")  # Error if extension is unsupported
+    return factory(file_path).load()
 
-# Function to process documents and split them into chunks for embedding
-def process_documents(ignored_files: List[str] = []) -> List[Document]:
+# Function to load a single document and split it into chunks (runs inside the worker processes)
+def load_and_split_document(file_path: str) -> Tuple[str, float, List[Document]]:
     """
-    Load documents, split them into smaller chunks, and return the chunks.
+    Loads a single document and returns its path, modification time and text chunks (tagged with that time).
     """
-    print(f"Loading documents from {source_directory}")
-    documents = load_documents(source_directory, ignored_files)
-    if not documents:
-        print("No new documents to load")
-        exit(0)  # Exit if no documents are found
-    print(f"Loaded {len(documents)} new documents from {source_directory}")
-    # Initialize the text splitter with defined chunk size and overlap
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    texts = text_splitter.split_documents(documents)
-    print(f"Split into {len(texts)} chunks of text (max. {chunk_size} tokens each)")
-    return texts
+    mtime = os.path.getmtime(file_path)
+    chunks = text_splitter.split_documents(load_single_document(file_path))
+    for chunk in chunks:
+        chunk.metadata['mtime'] = mtime
+    return file_path, mtime, chunks
+
+# Function to load a group of documents and split them into chunks (runs inside the worker processes)
+def load_and_split_documents(file_paths: List[str]) -> List[Tuple[str, float, List[Document]]]:
+    """
+    Loads and splits several documents, returning the path, modification time and chunks of each document in order.
+    """
+    return [load_and_split_document(file_path) for file_path in file_paths]
+
+# Function to find the files in the specified directory that still need to be ingested
+def find_new_files(source_dir: str, ingested_sources: Dict[str, float] = {}) -> List[str]:
+    """
+    Returns the supported files in the directory that are not ingested yet or were modified since.
+    ingested_sources maps each stored source to the modification time it was ingested with.
+    """
+    new_files = []  # List to store file paths
+    # Walk the directory tree once and keep every file with a supported extension (case insensitive),
+    # skipping already ingested files unless they changed on disk
+    for root, _, files in os.walk(source_dir):
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in LOADER_MAPPING:
+                continue
+            file_path = os.path.join(root, name)
+            if file_path in ingested_sources and os.path.getmtime(file_path) <= ingested_sources[file_path]:
+                continue
+            new_files.append(file_path)
+    return new_files
+
+# Function to load and split multiple documents
+def load_documents(file_paths: List[str]) -> Iterator[Tuple[str, float, List[Document]]]:
+    """
+    Loads and splits the given documents in parallel, yielding the path, modification time and chunks
+    of one document at a time.
+    At most tasks_in_flight groups of files are loaded ahead of the consumer, so memory stays bounded
+    however slowly the chunks are embedded.
+    """
+    # Files are sent to the workers in groups to cut down on inter-process round-trips
+    files_per_task = max(1, min(max_files_per_task, len(file_paths) // (ingest_workers * 4)))
+    tasks = (file_paths[start:start + files_per_task] for start in range(0, len(file_paths), files_per_task))
+    with Pool(processes=ingest_workers) as pool:
+        with tqdm(total=len(file_paths), desc='Loading new documents', ncols=80) as pbar:
+            pending = deque(pool.apply_async(load_and_split_documents, (task,))
+                            for task in islice(tasks, tasks_in_flight))
+            while pending:
+                results = pending.popleft().get()
+                # Submit the next task only once a result is consumed, so finished work cannot pile up
+                next_task = next(tasks, None)
+                if next_task is not None:
+                    pending.append(pool.apply_async(load_and_split_documents, (next_task,)))
+                for result in results:
+                    yield result
+                    pbar.update()  # Update progress bar
+
+# Function to process documents into batches of chunks ready for embedding
+def process_documents(file_paths: List[str], loaded_sources: Dict[str, float]) -> Iterator[List[Document]]:
+    """
+    Load documents, split them into smaller chunks, and yield the chunks in batches of upsert_batch_size.
+    Chunks repeated within a document are only kept once; the SHA-1 of the source and content is stored as
+    metadata['id'], so ids never collide across files and deleting one file's chunks leaves the others intact.
+    Memory holds at most one batch of chunks plus the documents load_documents() has loaded ahead.
+    Every loaded file is added to loaded_sources with its modification time, even if it produced no chunks.
+    """
+    buffer = []  # Chunks waiting to be embedded
+    n_chunks = 0
+    for file_path, mtime, chunks in load_documents(file_paths):
+        loaded_sources[file_path] = mtime
+        seen = set()  # Ids of the chunks produced so far for this document
+        for chunk in chunks:
+            # Skip repeated boilerplate (page headers, footers, disclaimers) instead of embedding it again
+            chunk_id = hashlib.sha1(f"{chunk.metadata['source']}\n{chunk.page_content}".encode()).hexdigest()
+            if chunk_id not in seen:
+                seen.add(chunk_id)
+                chunk.metadata['id'] = chunk_id
+                buffer.append(chunk)
+                n_chunks += 1
+        while len(buffer) >= upsert_batch_size:
+            batch, buffer = buffer[:upsert_batch_size], buffer[upsert_batch_size:]
+            yield batch
+    if buffer:
+        yield buffer
+    print(f"Loaded {len(file_paths)} new documents from {source_directory}, "
+          f"split into {n_chunks} unique chunks of text (max. {chunk_size} tokens each)")
 
 # Function to check if a VectorStore (embedding storage) exists in the specified directory
-def does_vectorstore_exist(persist_directory: str, embeddings: HuggingFaceBgeEmbeddings) -> bool:
+def does_vectorstore_exist(client: chromadb.ClientAPI) -> bool:
+    """
+    Checks if a VectorStore with embeddings already exists in the database opened by the client.
+    """
+    try:
+        # Count the stored chunks instead of fetching them all; no collection or no chunks means False
+        return client.get_collection(collection_name).count() > 0
+    except Exception:
+        return False
+
+# Function to read the source records of a Chroma collection
+def read_sources(collection: chromadb.Collection) -> Dict[str, Optional[float]]:
+    """
+    Returns the distinct sources in the collection mapped to their recorded modification time (None if missing),
+    reading the metadata in pages to keep memory bounded.
+    """
+    sources = {}
+    offset = 0
+    while True:
+        page = collection.get(include=['metadatas'], limit=metadata_page_size, offset=offset)
+        for metadata in page['metadatas']:
+            sources[metadata['source']] = metadata.get('mtime')
+        if len(page['metadatas']) < metadata_page_size:
+            return sources
+        offset += metadata_page_size
+
+# Function to record processed source files and their modification times
+def record_ingested_sources(client: chromadb.ClientAPI, sources: Dict[str, float]) -> None:
     """
-    Checks if a VectorStore with embeddings already exists in the specified directory.
+    Upserts one record per source into the sources collection, keyed by the SHA-1 of the source path.
     """
-    db = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
-    # If there are no documents, return False; otherwise, True
-    return bool(db.get()['documents'])
+    sources_collection = client.get_or_create_collection(sources_collection_name)
+    items = list(sources.items())
+    for start in range(0, len(items), sources_write_batch_size):
+        batch = items[start:start + sources_write_batch_size]
+        # The sources collection is never searched; a one-dimensional placeholder vector keeps Chroma from
+        # running its default embedding function on these records
+        sources_collection.upsert(ids=[hashlib.sha1(source.encode()).hexdigest() for source, _ in batch],
+                                  embeddings=[[0.0]] * len(batch),
+                                  metadatas=[{'source': source, 'mtime': mtime} for source, mtime in batch])
+
+# Function to list the source files that were already ingested
+def get_ingested_sources(client: chromadb.ClientAPI) -> Dict[str, float]:
+    """
+    Returns every ingested source mapped to the modification time it was ingested with.
+    """
+    existing_collections = {}
+    for name in (sources_collection_name, collection_name):
+        try:
+            existing_collections[name] = client.get_collection(name)
+        except Exception:
+            pass  # The collection has not been created yet
+    if sources_collection_name in existing_collections:
+        return read_sources(existing_collections[sources_collection_name])
+    if collection_name not in existing_collections:
+        return {}
+    # Vectorstores built before sources were recorded: derive the sources from the stored chunks once,
+    # treating them as up to date, and record them for the following runs
+    sources = read_sources(existing_collections[collection_name])
+    sources = {source: mtime if mtime is not None else
+               (os.path.getmtime(source) if os.path.exists(source) else 0.0)
+               for source, mtime in sources.items()}
+    record_ingested_sources(client, sources)
+    return sources
+
+# Function to embed batches of chunks and write them to a Chroma collection
+def upsert_documents(collection: chromadb.Collection, embeddings: Embeddings,
+                     batches: Iterable[List[Document]]) -> None:
+    """
+    Embeds each batch of chunks and upserts it into the collection as soon as it is produced.
+    Chunks whose id is already stored are skipped, so re-ingesting an unchanged document is a no-op.
+    """
+    for batch in batches:
+        existing = set(collection.get(ids=[text.metadata['id'] for text in batch], include=[])['ids'])
+        batch = [text for text in batch if text.metadata['id'] not in existing]
+        if not batch:
+            continue
+        documents = [text.page_content for text in batch]
+        metadatas = [text.metadata for text in batch]
+        collection.upsert(ids=[metadata['id'] for metadata in metadatas],
+                          embeddings=embeddings.embed_documents(documents),
+                          documents=documents, metadatas=metadatas)
 
 # Main function to execute the embedding and storage process
 def main():
-    # Initialize embeddings using the specified HuggingFace model
-    embeddings = HuggingFaceBgeEmbeddings(model_name=embeddings_model_name)
+    # Give PyTorch the cores not used by the loader workers, then load and warm up the embeddings model
+    torch.set_num_threads(torch_num_threads)
+    # Initialize embeddings using the specified model, backend and device
+    embeddings = load_embeddings(embeddings_backend, embeddings_model_name, embeddings_device, embeddings_batch_size,
+                                 fp16=embeddings_fp16, int8=embeddings_int8, multi_gpu=True)
     # Create a Chroma client with defined settings
     chroma_client = chromadb.PersistentClient(settings=CHROMA_SETTINGS, path=persist_directory)
     
     # Check if a vectorstore already exists
-    if does_vectorstore_exist(persist_directory, embeddings):
+    if does_vectorstore_exist(chroma_client):
         print(f"Appending to existing vectorstore at {persist_directory}")
-        db = Chroma(persist_directory=persist_directory, embedding_function=embeddings,
-                    client_settings=CHROMA_SETTINGS, client=chroma_client)
-        collection = db.get()
-        # Process documents, ignoring those already stored
-        texts = process_documents([metadata['source'] for metadata in collection['metadatas']])
-        print("Creating embeddings. This may take a few minutes...")
-        db.add_documents(texts)  # Add new embeddings
     else:
         print("Creating new vectorstore")
-        texts = process_documents()
-        print("Creating embeddings. This may take a few minutes...")
-        db = Chroma.from_documents(texts, embeddings, persist_directory=persist_directory,
-                                   client_settings=CHROMA_SETTINGS, client=chroma_client)
+    # Files processed by earlier runs, including those that produced no chunks
+    ingested_sources = get_ingested_sources(chroma_client)
+    
+    # Only new or modified files are sent to the loader workers
+    print(f"Loading documents from {source_directory}")
+    file_paths = find_new_files(source_directory, ingested_sources)
+    if not file_paths:
+        print("No new documents to load")
+        exit(0)  # Exit if no documents are found
+    try:
+        collection = chroma_client.get_collection(collection_name)
+    except Exception:
+        # HNSW settings can only be chosen at creation time, so they are only passed for a new collection
+        collection = chroma_client.create_collection(collection_name, metadata=collection_metadata)
+    # Remove the outdated chunks of modified files before they are ingested again
+    modified_files = [file_path for file_path in file_paths if file_path in ingested_sources]
+    if modified_files:
+        collection.delete(where={'source': {'$in': modified_files}})
     
-    db.persist()  # Save vectorstore to disk
-    db = None  # Close connection
+    print("Creating embeddings. This may take a few minutes...")
+    # Documents are loaded, split, embedded and stored as a stream, with a bounded number of documents in flight.
+    # The persistent client writes every upsert to disk, so no explicit persist step is needed
+    loaded_sources = {}  # Filled in by process_documents() as files are loaded
+    upsert_documents(collection, embeddings, process_documents(file_paths, loaded_sources))
+    # Record the processed files only once their chunks are stored, so an interrupted run is simply redone
+    record_ingested_sources(chroma_client, loaded_sources)
     print("Ingestion complete! You can now run PrivateGPT.py to query your documents.")
 
 # Execute the main function when the script runs
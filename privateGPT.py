@@ -2,14 +2,15 @@
 import chromadb  # For managing ChromaDB, the vector storage
 import os  # To handle operating system operations and environment variables
 import argparse  # For parsing command-line arguments
+import asyncio  # To run the question-answering chain asynchronously
 import time  # To measure response time for answering queries
+import torch  # To detect whether a CUDA-capable GPU is available for embeddings
 from dotenv import load_dotenv  # To load environment variables from a .env file
 from langchain.chains import RetrievalQA  # To handle question-answering with retrieval
-from langchain.embeddings import HuggingFaceBgeEmbeddings  # For embedding text with HuggingFace models
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler  # For streaming responses
 from langchain.vectorstores import Chroma  # For Chroma vector store management
-from langchain.llms import GPT4All, Llamacpp  # For handling different LLMs (GPT-4All and LlamaCpp)
 from constants import CHROMA_SETTINGS  # Import Chroma configuration settings
+from embedding_backends import load_embeddings  # Builds the embeddings model for the configured backend
 
 # Load environment variables from the .env file if it exists
 if not load_dotenv():
@@ -18,20 +19,54 @@ if not load_dotenv():
 
 # Retrieve environment variables for model and storage configurations
 embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME")  # Name of embeddings model
+embeddings_backend = os.environ.get("EMBEDDINGS_BACKEND", "huggingface")  # "huggingface" (PyTorch) or "onnx"
+# Device for the embeddings model; defaults to the GPU when one is available
+embeddings_device = os.environ.get("EMBEDDINGS_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+embeddings_fp16 = os.environ.get("EMBEDDINGS_FP16", "0") == "1"  # Run the embeddings model in FP16 on the GPU
+embeddings_int8 = os.environ.get("EMBEDDINGS_INT8", "0") == "1"  # Quantize the embeddings model to INT8 on the CPU
+torch_num_threads = int(os.environ.get("TORCH_NUM_THREADS", os.cpu_count()))  # CPU threads used by PyTorch
 persist_directory = os.environ.get("PERSIST_DIRECTORY")  # Directory path for Chroma database storage
 model_type = os.environ.get("MODEL_TYPE")  # Model type (e.g., "GPT4ALL" or "LlamaCpp")
 model_path = os.environ.get("MODEL_PATH")  # Path to the model file
 model_n_ctx = os.environ.get("MODEL_N_CTX")  # Context size for the model
-model_n_batch = int(os.environ.get("MODEL_N_BATCH"), 8)  # Batch size for processing
-target_source_chunks = int(os.environ.get("TARGET_SOURCE_CHUNKS"), 4)  # Number of chunks for retrieval
+model_n_batch = int(os.environ.get("MODEL_N_BATCH", 8))  # Batch size for processing
+model_max_tokens = int(os.environ.get("MODEL_MAX_TOKENS", 512))  # Maximum number of tokens generated per answer
+model_n_threads = int(os.environ.get("MODEL_N_THREADS", os.cpu_count()))  # CPU threads used by LlamaCpp
+n_gpu_layers = int(os.environ.get("N_GPU_LAYERS", -1))  # Layers offloaded to the GPU by LlamaCpp (-1 = all)
+target_source_chunks = int(os.environ.get("TARGET_SOURCE_CHUNKS", 4))  # Number of chunks for retrieval
+
+# Functions to set up each supported LLM; the backend is only imported when it is selected,
+# so choosing GPT4All never pays for importing llama-cpp-python and vice versa
+def _load_llamacpp(callbacks):
+    from langchain.llms import LlamaCpp
+    # Set up LlamaCpp model, offloading layers to the GPU and memory-mapping the weights
+    return LlamaCpp(model_path=model_path, n_ctx=int(model_n_ctx), max_tokens=model_max_tokens,
+                    n_batch=model_n_batch, n_threads=model_n_threads, n_gpu_layers=n_gpu_layers,
+                    use_mmap=True, f16_kv=True, callbacks=callbacks, verbose=False)
+
+def _load_gpt4all(callbacks):
+    from langchain.llms import GPT4All
+    # Set up GPT4All model with the necessary parameters
+    return GPT4All(model=model_path, n_ctx=int(model_n_ctx), max_tokens=model_max_tokens, backend='gptj',
+                   n_batch=model_n_batch, callbacks=callbacks, verbose=False)
+
+# Registry of supported model types (matched case-insensitively against MODEL_TYPE)
+MODEL_REGISTRY = {
+    "llamacpp": _load_llamacpp,
+    "gpt4all": _load_gpt4all,
+}
 
 # Main function to initialize the LLM, ChromaDB, and embedding model and manage the Q&A interaction
-def main():
+async def main():
     # Parse command-line arguments for configuring source visibility and streaming
     args = parse_arguments()
     
-    # Initialize the embeddings model
-    embeddings = HuggingFaceBgeEmbeddings(model_name=embeddings_model_name)
+    # Let PyTorch use every core for the embeddings model
+    torch.set_num_threads(torch_num_threads)
+    
+    # Initialize (and warm up) the embeddings model with the selected backend and device
+    embeddings = load_embeddings(embeddings_backend, embeddings_model_name, embeddings_device, 64,
+                                 fp16=embeddings_fp16, int8=embeddings_int8)
     
     # Set up a persistent Chroma client with pre-defined settings
     chroma_client = chromadb.PersistentClient(settings=CHROMA_SETTINGS, path=persist_directory)
@@ -47,18 +82,11 @@ def main():
     callbacks = [] if args.mute_stream else [StreamingStdOutCallbackHandler()]
     
     # Initialize the language model based on the model type specified in the environment variable
-    match model_type:
-        case "LlamaCpp":
-            # Set up LlamaCpp model with required parameters
-            llm = Llamacpp(model_path=model_path, max_tokens=model_n_ctx,
-                           n_batch=model_n_batch, callbacks=callbacks, verbose=False)
-        case "GPT4ALL":
-            # Set up GPT4All model with the necessary parameters
-            llm = GPT4All(model=model_path, max_tokens=model_n_ctx, backend='gptj',
-                          n_batch=model_n_batch, callbacks=callbacks, verbose=False)
-        case _default:
-            # Raise an error if an unsupported model type is specified
-            raise Exception(f"Model Type {model_type} is not supported. Please choose either 'LlamaCpp' or 'GPT4All'")
+    load_llm = MODEL_REGISTRY.get((model_type or "").lower())
+    if load_llm is None:
+        # Raise an error if an unsupported model type is specified
+        raise Exception(f"Model Type {model_type} is not supported. Please choose either 'LlamaCpp' or 'GPT4All'")
+    llm = load_llm(callbacks)
     
     # Initialize the question-answering chain with the LLM and document retriever
     qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever,
@@ -66,7 +94,7 @@ def main():
     
     # Start an interactive Q&A loop
     while True:
-        # Prompt the user to enter a query
+        # Prompt the user to enter a query (read directly, so Ctrl-C at the prompt exits immediately)
         query = input("\n Enter a query: ")
         
         # Exit the loop if the user types "exit"
@@ -78,7 +106,7 @@ def main():
         
         # Process the query and measure the time taken
         start = time.time()
-        res = qa(query)
+        res = await qa.acall({"query": query})
         answer = res['result']
         docs = [] if args.hide_source else res['source_documents']
         end = time.time()
@@ -106,4 +134,4 @@ def parse_arguments():
 
 # Execute the main function if this script is run directly
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())